@@ -22,14 +22,20 @@
 # ***************************************************************************
 
 from __future__ import print_function
-import FreeCAD
-from FreeCAD import Units
-import Path
 import argparse
+import collections
 import datetime
+import functools
+import io
 import shlex
-from PathScripts import PostUtils
-from PathScripts import PathUtils
+
+# FreeCAD modules are imported on first use by loadFreeCAD(), since importing
+# them is slow and isn't needed to load the post processor.
+FreeCAD = None
+Units = None
+Path = None
+PostUtils = None
+PathUtils = None
 
 TOOLTIP = '''
 This is a postprocessor file for the Path workbench. It is used to
@@ -64,8 +70,6 @@ for FreeCAD.
 #   M3 and M5 are not defined by default, but are included as
 #   macros (which is why using M3 and M5 commands work in your gcode).
 
-now = datetime.datetime.now()
-
 parser = argparse.ArgumentParser(prog='wincnc', add_help=False)
 parser.add_argument('--no-header', action='store_true', help='suppress header output')
 parser.add_argument('--no-comments', action='store_true', help='suppress comment output')
@@ -81,6 +85,24 @@ parser.add_argument('--no-tlo', action='store_true', help='suppress tool length
 
 TOOLTIP_ARGS = parser.format_help()
 
+# argparse is only needed to render TOOLTIP_ARGS and to report malformed
+# arguments; well-formed argument strings are tokenized against this map of
+# flag -> (argparse dest, whether the flag takes a value) instead.
+FLAG_ACTIONS = {
+    '--no-header': ('no_header', False),
+    '--no-comments': ('no_comments', False),
+    '--line-numbers': ('line_numbers', False),
+    '--no-show-editor': ('no_show_editor', False),
+    '--precision': ('precision', True),
+    '--preamble': ('preamble', True),
+    '--postamble': ('postamble', True),
+    '--inches': ('inches', False),
+    '--modal': ('modal', False),
+    '--axis-modal': ('axis_modal', False),
+    '--no-tlo': ('no_tlo', False),
+}
+ARG_DEFAULTS = vars(parser.parse_args([]))
+
 # These globals set common customization preferences
 OUTPUT_COMMENTS = True
 OUTPUT_HEADER = True
@@ -151,6 +173,9 @@ G5 T2 M"Continue Job?"
 
 first_tool_change_skipped = False
 
+# WinCNC comments are enclosed by square brackets rather than parentheses
+PAREN_TO_BRACKET = str.maketrans('()', '[]')
+
 # to distinguish python built-in open function from the one declared below
 if open.__module__ in ['__builtin__','io']:
     pythonopen = open
@@ -173,7 +198,10 @@ def processArguments(argstring):
     global OUTPUT_DOUBLES
 
     try:
-        args = parser.parse_args(shlex.split(argstring))
+        # the GUI passes an empty string by default; there is nothing to
+        # tokenize, but the defaults (e.g. PRECISION) still get applied.
+        tokens = shlex.split(argstring) if argstring and not argstring.isspace() else []
+        args = parseFlags(tokens)
         if args.no_header:
             OUTPUT_HEADER = False
         if args.no_comments:
@@ -206,10 +234,47 @@ def processArguments(argstring):
 
     return True
 
-def export(objectslist, filename, argstring):
+def loadFreeCAD():
+    # pylint: disable=global-statement,import-outside-toplevel,redefined-outer-name
+    global FreeCAD
+    global Units
+    global Path
+    global PostUtils
+    global PathUtils
+
+    if FreeCAD is not None:
+        return
+    import FreeCAD
+    from FreeCAD import Units
+    import Path
+    from PathScripts import PostUtils
+    from PathScripts import PathUtils
+
+def parseFlags(tokens):
+    args = argparse.Namespace(**ARG_DEFAULTS)
+    i = 0
+    while i < len(tokens):
+        action = FLAG_ACTIONS.get(tokens[i])
+        if action is None:
+            # unknown, abbreviated or --flag=value forms: let argparse handle
+            # (and report) them.
+            return parser.parse_args(tokens)
+        dest, takes_value = action
+        if takes_value:
+            if i + 1 >= len(tokens) or tokens[i + 1].startswith('-'):
+                return parser.parse_args(tokens)
+            setattr(args, dest, tokens[i + 1])
+            i += 2
+        else:
+            setattr(args, dest, True)
+            i += 1
+    return args
+
+
+def writeGcode(objectslist, fileobj):
+    # writes the gcode for objectslist to fileobj, one operation at a time.
+    # returns False if objectslist contains something that isn't a path.
     # pylint: disable=global-statement
-    if not processArguments(argstring):
-        return None
     global UNITS
     global UNIT_FORMAT
     global UNIT_SPEED_FORMAT
@@ -217,25 +282,29 @@ def export(objectslist, filename, argstring):
     for obj in objectslist:
         if not hasattr(obj, "Path"):
             print("the object " + obj.Name + " is not a path. Please select only path and Compounds.")
-            return None
+            return False
 
     print("postprocessing...")
-    gcode = ""
+    parts = []
+    linenumber = lineNumberer()
 
     # write header
     if OUTPUT_HEADER:
-        gcode += linenumber() + "[Exported by FreeCAD]\n"
-        gcode += linenumber() + "[Post Processor: " + __name__ + "]\n"
-        gcode += linenumber() + "[Output Time:" + str(now) + "]\n\n"
+        now = datetime.datetime.now()
+        parts.append(linenumber() + "[Exported by FreeCAD]\n")
+        parts.append(linenumber() + "[Post Processor: " + __name__ + "]\n")
+        parts.append(linenumber() + "[Output Time:" + str(now) + "]\n\n")
 
     # Write the preamble
     if OUTPUT_COMMENTS:
-        gcode += linenumber() + "[Begin Preamble]\n"
-    for line in PREAMBLE.splitlines(False):
-        gcode += linenumber() + line + "\n"
-    gcode += linenumber() + UNITS + "\t\t[Units: " + UNIT_FORMAT + "]\n\n"
+        parts.append(linenumber() + "[Begin Preamble]\n")
+    emitBlock(parts, linenumber, PREAMBLE, False, "\n")
+    parts.append(linenumber() + UNITS + "\t\t[Units: " + UNIT_FORMAT + "]\n\n")
+    fileobj.writelines(parts)
 
     for obj in objectslist:
+        # only one operation's gcode is held in memory at a time
+        parts = []
 
         # Skip inactive operations
         if hasattr(obj, 'Active'):
@@ -268,10 +337,9 @@ def export(objectslist, filename, argstring):
 
         # do the pre_op
         if OUTPUT_COMMENTS:
-            gcode += linenumber() + "[Operation: " + obj.Label + \
-                " (" + UNIT_SPEED_FORMAT + ")]\n"
-        for line in PRE_OPERATION.splitlines(True):
-            gcode += linenumber() + line + "\n"
+            parts.append(linenumber() + "[Operation: " + obj.Label +
+                         " (" + UNIT_SPEED_FORMAT + ")]\n")
+        emitBlock(parts, linenumber, PRE_OPERATION, True, "\n")
 
         # get coolant mode
         coolantMode = 'None'
@@ -284,31 +352,62 @@ def export(objectslist, filename, argstring):
         # turn coolant on if required
         if OUTPUT_COMMENTS:
             if not coolantMode == 'None':
-                gcode += linenumber() + '[Coolant On:' + coolantMode + ']\n'
+                parts.append(linenumber() + '[Coolant On:' + coolantMode + ']\n')
         if coolantMode == 'Flood':
-            gcode  += linenumber() + 'M8' + '\n'
+            parts.append(linenumber() + 'M8' + '\n')
         if coolantMode == 'Mist':
-            gcode += linenumber() + 'M7' + '\n'
+            parts.append(linenumber() + 'M7' + '\n')
 
         # process the operation gcode
-        gcode += parse(obj)
+        parseInto(obj, parts, linenumber)
 
         # do the post_op
-        for line in POST_OPERATION.splitlines(True):
-            gcode += linenumber() + line + ""
-        gcode += "\n"
+        emitBlock(parts, linenumber, POST_OPERATION, True)
+        parts.append("\n")
 
         # turn coolant off if required
         if not coolantMode == 'None':
             if OUTPUT_COMMENTS:
-                gcode += linenumber() + '[Coolant Off:' + coolantMode + ']\n'
-            gcode  += linenumber() +'M9' + '\n'
+                parts.append(linenumber() + '[Coolant Off:' + coolantMode + ']\n')
+            parts.append(linenumber() +'M9' + '\n')
+
+        fileobj.writelines(parts)
 
     # do the post_amble
+    parts = []
     if OUTPUT_COMMENTS:
-        gcode += "[Postamble]\n"
-    for line in POSTAMBLE.splitlines(True):
-        gcode += linenumber() + line
+        parts.append("[Postamble]\n")
+    emitBlock(parts, linenumber, POSTAMBLE, True)
+    fileobj.writelines(parts)
+
+    return True
+
+
+def exportStream(objectslist, fileobj, argstring):
+    # like export(), but writes the gcode straight to the file-like fileobj
+    # (e.g. an open file) without building the whole program in memory or
+    # showing the editor. returns None on failure.
+    if not processArguments(argstring):
+        return None
+
+    loadFreeCAD()
+
+    if not writeGcode(objectslist, fileobj):
+        return None
+
+    print("done postprocessing.")
+    return True
+
+
+def export(objectslist, filename, argstring):
+    if not processArguments(argstring):
+        return None
+    loadFreeCAD()
+
+    buf = io.StringIO()
+    if not writeGcode(objectslist, buf):
+        return None
+    gcode = buf.getvalue()
 
     if FreeCAD.GuiUp and SHOW_EDITOR:
         final = gcode
@@ -333,16 +432,117 @@ def export(objectslist, filename, argstring):
     return final
 
 
-def linenumber():
-    # pylint: disable=global-statement
-    global LINENR
-    if OUTPUT_LINE_NUMBERS is True:
-        LINENR += 10
-        return "N" + str(LINENR) + " "
+def noLineNumber():
     return ""
 
 
-def parse(pathobj):
+def lineNumberer():
+    # returns a fresh line number generator for a single export, starting
+    # from LINENR. the counter is local so exports don't continue each
+    # other's numbering.
+    if OUTPUT_LINE_NUMBERS is not True:
+        return noLineNumber
+    counter = [LINENR]
+
+    def linenumber():
+        counter[0] += 10
+        return "N%d " % counter[0]
+    return linenumber
+
+
+@functools.lru_cache(maxsize=None)
+def splitBlock(text, keepends, suffix=""):
+    # the preamble/postamble/operation/tool change blocks are constant between
+    # exports (unless overridden by arguments), so only split each distinct
+    # text once.
+    lines = tuple(line + suffix for line in text.splitlines(keepends))
+    return lines, "".join(lines)
+
+
+def emitBlock(parts, linenumber, text, keepends, suffix=""):
+    lines, joined = splitBlock(text, keepends, suffix)
+    if OUTPUT_LINE_NUMBERS:
+        for line in lines:
+            parts.append(linenumber() + line)
+    else:
+        parts.append(joined)
+
+
+def _int_handler(param, value, state):
+    return param + state['int_fmt'](int(value))
+
+
+def _feed_handler(param, value, state):
+    if state['command'] in ["G0", "G00"]:  # linuxcnc doesn't use rapid speeds
+        return None
+    # a job only uses a handful of feed rates, so format each one once.
+    words = state['words'][param]
+    word = words.get(value)
+    if word is None:
+        speed = value * state['speed_factor']
+        word = param + state['fmt'](speed) if speed > 0.0 else ""
+        words[value] = word
+    return word or None
+
+
+def _length_handler(param, value, state):
+    return param + state['fmt'](value * state['length_factor'])
+
+
+def _repeated_length_handler(param, value, state):
+    # for axes that keep revisiting the same few values (e.g. Z depths and
+    # clearance heights), format each value once. mostly unique values (X/Y)
+    # are cheaper to format directly than to cache.
+    words = state['words'][param]
+    word = words.get(value)
+    if word is None:
+        word = _length_handler(param, value, state)
+        if value:  # 0.0 and -0.0 compare equal but format differently
+            words[value] = word
+    return word
+
+
+# maps each output parameter to the function formatting its word, or
+# returning None if the word should be suppressed.
+PARAM_HANDLERS = {
+    'X': _length_handler,
+    'Y': _length_handler,
+    'Z': _repeated_length_handler,
+    'A': _length_handler,
+    'B': _length_handler,
+    'C': _length_handler,
+    'I': _length_handler,
+    'J': _length_handler,
+    'S': _int_handler,
+    'T': _int_handler,
+    'Q': _length_handler,
+    'R': _length_handler,
+    'F': _feed_handler,
+    'L': _length_handler,
+    'H': _int_handler,
+    'D': _int_handler,
+    'P': _length_handler,
+}
+
+# parameters whose word is suppressed when unchanged from the previous command
+# (see OUTPUT_DOUBLES). integer words (tool, offsets, spindle speed) are always
+# output.
+MODAL_PARAMS = frozenset(
+    param for param, handler in PARAM_HANDLERS.items() if handler is not _int_handler)
+
+
+def parse(pathobj, linenumber=None):
+    loadFreeCAD()
+    if linenumber is None:
+        linenumber = lineNumberer()
+    out = []
+    parseInto(pathobj, out, linenumber)
+    return "".join(out)
+
+
+def parseInto(pathobj, out, linenumber):
+    # appends the gcode for pathobj to the caller's `out` list, so compounds
+    # of any depth are only joined once by the caller.
     # pylint: disable=global-statement
     global PRECISION
     global MODAL
@@ -352,130 +552,129 @@ def parse(pathobj):
     global SKIP_FIRST_TOOLCHANGE
     global first_tool_change_skipped
 
-    out = ""
-    lastcommand = None
-    precision_string = '.' + str(PRECISION) + 'f'
-    currLocation = {}  # keep track for no doubles
-
-    # the order of parameters
-    # linuxcnc doesn't want K properties on XY plane  Arcs need work.
-    params = ['X', 'Y', 'Z', 'A', 'B', 'C', 'I', 'J', 'S', 'T', 'Q', 'R', 'F', 'L', 'H', 'D', 'P']
-    firstmove = Path.Command("G0", {"X": -1, "Y": -1, "Z": -1, "F": 0.0})
-    currLocation.update(firstmove.Parameters)  # set First location Parameters
-
     if hasattr(pathobj, "Group"):  # We have a compound or project.
         # if OUTPUT_COMMENTS:
         #     out += linenumber() + "(compound: " + pathobj.Label + ")\n"
         for p in pathobj.Group:
-            out += parse(p)
-        return out
-    else:  # parsing simple path
+            parseInto(p, out, linenumber)
+        return
 
-        # groups might contain non-path things like stock.
-        if not hasattr(pathobj, "Path"):
-            return out
+    # groups might contain non-path things like stock.
+    if not hasattr(pathobj, "Path"):
+        return
 
-        # if OUTPUT_COMMENTS:
-        #     out += linenumber() + "(" + pathobj.Label + ")\n"
-
-        for c in pathobj.Path.Commands:
-
-            outstring = []
-            command = c.Name
-            outstring.append(command)
+    lastcommand = None
+    fmt = ("{:." + str(PRECISION) + "f}").format
+    int_fmt = "{:d}".format
+    notify_tool_change = TOOL_CHANGE_NOTIFICATION.format_map
+    # the last location is only needed to suppress unchanged values
+    track_location = not OUTPUT_DOUBLES
+    modal = MODAL
+    output_comments = OUTPUT_COMMENTS
+    currLocation = {}  # keep track for no doubles
 
-            # if modal: suppress the command if it is the same as the last one
-            if MODAL is True:
-                if command == lastcommand:
-                    outstring.pop(0)
+    # the unit conversion is constant for the whole export, so compute the
+    # scale factors once rather than building a Quantity per parameter.
+    length_factor = float(Units.Quantity(1.0, FreeCAD.Units.Length).getValueAs(UNIT_FORMAT))
+    speed_factor = float(Units.Quantity(1.0, FreeCAD.Units.Velocity).getValueAs(UNIT_SPEED_FORMAT))
 
-            if c.Name[0] == '(': # command is a comment
-                if not OUTPUT_COMMENTS:
-                    continue
-                else:
-                    outstring.pop()
-                    outstring.append(command.replace('(', '[').replace(')', ']'))
+    # the order of parameters
+    # linuxcnc doesn't want K properties on XY plane  Arcs need work.
+    params = ['X', 'Y', 'Z', 'A', 'B', 'C', 'I', 'J', 'S', 'T', 'Q', 'R', 'F', 'L', 'H', 'D', 'P']
+    firstmove = Path.Command("G0", {"X": -1, "Y": -1, "Z": -1, "F": 0.0})
+    currLocation.update(firstmove.Parameters)  # set First location Parameters
 
-            # intercept G99 -- not supported by WinCNC
-            if c.Name == "G99":
+    state = {
+        'fmt': fmt,
+        'int_fmt': int_fmt,
+        'length_factor': length_factor,
+        'speed_factor': speed_factor,
+        'command': None,
+        'words': collections.defaultdict(dict),
+    }
+
+    # if OUTPUT_COMMENTS:
+    #     out += linenumber() + "(" + pathobj.Label + ")\n"
+
+    for c in pathobj.Path.Commands:
+
+        command = c.Name
+
+        # drop comments and messages up front when they aren't output
+        if not output_comments and (command == "message" or command.startswith('(')):
+            continue
+
+        outstring = []
+        append = outstring.append
+        append(command)
+
+        # if modal: suppress the command if it is the same as the last one
+        if modal is True:
+            if command == lastcommand:
+                outstring.pop(0)
+
+        if command.startswith('('): # command is a comment
+            outstring.pop()
+            append(command.translate(PAREN_TO_BRACKET))
+
+        # intercept G99 -- not supported by WinCNC
+        if command == "G99":
+            continue
+
+        # Now add the remaining parameters in order
+        parameters = c.Parameters
+        state['command'] = command
+        for param in params:
+            value = parameters.get(param)
+            if value is None:
                 continue
-
-            # Now add the remaining parameters in order
-            for param in params:
-                if param in c.Parameters:
-                    if param == 'F' and (currLocation[param] != c.Parameters[param] or OUTPUT_DOUBLES):
-                        if c.Name not in ["G0", "G00"]:  # linuxcnc doesn't use rapid speeds
-                            speed = Units.Quantity(c.Parameters['F'], FreeCAD.Units.Velocity)
-                            if speed.getValueAs(UNIT_SPEED_FORMAT) > 0.0:
-                                outstring.append(param + format(float(speed.getValueAs(UNIT_SPEED_FORMAT)), precision_string))
-                        else:
-                            continue
-                    elif param == 'T':
-                        outstring.append(param + str(int(c.Parameters['T'])))
-                    elif param == 'H':
-                        outstring.append(param + str(int(c.Parameters['H'])))
-                    elif param == 'D':
-                        outstring.append(param + str(int(c.Parameters['D'])))
-                    elif param == 'S':
-                        outstring.append(param + str(int(c.Parameters['S'])))
-                    else:
-                        if (not OUTPUT_DOUBLES) and (param in currLocation) and (currLocation[param] == c.Parameters[param]):
-                            continue
-                        else:
-                            pos = Units.Quantity(c.Parameters[param], FreeCAD.Units.Length)
-                            outstring.append(
-                                param + format(float(pos.getValueAs(UNIT_FORMAT)), precision_string))
-
-            # store the latest command
-            lastcommand = command
-            currLocation.update(c.Parameters)
-
-            # Check for Tool Change:
-            if command == 'M6':
-                # since we are assuming that the operator has already measured the tool
-                # and zeroed the tooltip before starting the job, we do not run the tool
-                # change operation for the initial tool.
-                if SKIP_FIRST_TOOLCHANGE and not first_tool_change_skipped:
-                    first_tool_change_skipped = True
+            # check for an unchanged value before doing any conversion, and
+            # only store the values that actually changed.
+            if track_location and param in MODAL_PARAMS:
+                if currLocation.get(param) == value:
                     continue
+                currLocation[param] = value
+            word = PARAM_HANDLERS[param](param, value, state)
+            if word is not None:
+                append(word)
+
+        # store the latest command
+        lastcommand = command
+
+        # Check for Tool Change:
+        if command == 'M6':
+            # since we are assuming that the operator has already measured the tool
+            # and zeroed the tooltip before starting the job, we do not run the tool
+            # change operation for the initial tool.
+            if SKIP_FIRST_TOOLCHANGE and not first_tool_change_skipped:
+                first_tool_change_skipped = True
+                continue
 
-                for line in PRE_TOOL_CHANGE.splitlines(True):
-                    out += linenumber() + line
-
-                out += TOOL_CHANGE_NOTIFICATION.format(tool_num = pathobj.Tool.Label)
-
-                for line in TOOL_CHANGE.splitlines(True):
-                    out += linenumber() + line
-
-                # add height offset
-                # M37 (used in the TOOL_CHANGE gcodes) enables G43 in WinCNC, so we
-                # don't have to explicitly set it. (see p.32)
-                # if USE_TLO:
-                #     tool_height = '\nG43 H' + str(int(c.Parameters['T']))
-                #     out += linenumber() + tool_height + "\n"
+            emitBlock(out, linenumber, PRE_TOOL_CHANGE, True)
+            out.append(notify_tool_change({'tool_num': pathobj.Tool.Label}))
+            emitBlock(out, linenumber, TOOL_CHANGE, True)
 
-                # do not actually add the M6 command: WinCNC doesn't recognize it.
-                continue
+            # add height offset
+            # M37 (used in the TOOL_CHANGE gcodes) enables G43 in WinCNC, so we
+            # don't have to explicitly set it. (see p.32)
+            # if USE_TLO:
+            #     tool_height = '\nG43 H' + str(int(c.Parameters['T']))
+            #     out += linenumber() + tool_height + "\n"
 
+            # do not actually add the M6 command: WinCNC doesn't recognize it.
+            continue
 
-            if command == "message":
-                if OUTPUT_COMMENTS is False:
-                    out = []
-                else:
-                    outstring.pop(0)  # remove the command
 
-            # prepend a line number and append a newline
-            if len(outstring) >= 1:
-                if OUTPUT_LINE_NUMBERS:
-                    outstring.insert(0, (linenumber()))
+        if command == "message":
+            outstring.pop(0)  # remove the command
 
-                # append the line to the final output
-                for w in outstring:
-                    out += w + COMMAND_SPACE
-                # Note: Do *not* strip `out`, since that forces the allocation
-                # of a contiguous string & thus quadratic complexity.
-                out += "\n"
+        # prepend a line number and append a newline
+        if len(outstring) >= 1:
+            if OUTPUT_LINE_NUMBERS:
+                outstring.insert(0, (linenumber()))
 
-        return out
+            # append the line to the final output
+            out.append(COMMAND_SPACE.join(outstring))
+            out.append("\n")
 
 # print(__name__ + " gcode postprocessor loaded.")